@@ -1,20 +1,49 @@
 import os
 import tempfile
 import base64
+import hashlib
 import random
+import threading
+from collections import OrderedDict, deque
+from itertools import count
 from datetime import datetime, time, timedelta
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 from PIL import Image
 import numpy as np
 from io import BytesIO
 from google_photos_sync import GooglePhotosSync, get_album_id_from_url
 
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    # Numba is optional; dithering falls back to a slower pure-Python loop
+    HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 app = Flask(__name__)
 
 # In-memory storage for images (since we can't use local file system reliably in cloud)
-processed_images = []
-sent_images = []
+# Bounded so a long-running server evicts its oldest frames instead of growing
+MAX_IMAGES = 200
+processed_images = deque(maxlen=MAX_IMAGES)
+sent_images = deque(maxlen=MAX_IMAGES)
+sent_ids = set()  # id() of each entry in sent_images, for O(1) membership
 current_image_index = 0
+# Numbers unnamed uploads; keeps counting once the deque starts evicting
+upload_counter = count(1)
+
+# Wakeup schedule: hourly updates from 8 AM to 8 PM, deep sleep overnight
+MORNING = time(8, 0)
+EVENING = time(20, 0)
+DAY_INTERVAL = 3600  # 1 hour in seconds
+
+# Recently processed frames, keyed by SHA-256 of the decoded image bytes
+IMG_CACHE_SIZE = 64
+_IMG_CACHE = OrderedDict()
 
 # Google Photos sync instance
 google_sync = GooglePhotosSync()
@@ -30,6 +59,15 @@ color_palette = {
     (0, 0, 0): 0x00         # Black
 }
 
+# Palette as an int16 array (same order as color_palette) for the dither kernel
+palette_arr = np.array(list(color_palette), dtype=np.int16)
+# Palette index -> ESP32 color code
+CODE_LUT = np.array(list(color_palette.values()), dtype=np.uint8)
+# Byte value -> "0xNN" string used when serializing frames for the ESP32
+HEXSTR = np.array([f"0x{i:02X}" for i in range(256)], dtype=object)
+
+# Kept for callers of the old API; the dither and encode paths search the
+# palette inside _fs_dither instead
 def closest_palette_color(rgb):
     """Find the closest color in the palette."""
     min_dist = float('inf')
@@ -41,56 +79,252 @@ def closest_palette_color(rgb):
             closest_color = palette_rgb
     return closest_color
 
+# Horizontal stripes dithered independently (and in parallel with Numba).
+# Fixed rather than derived from the CPU count: it decides where error
+# diffusion restarts, so it must not change the frame bytes between hosts.
+DITHER_STRIPES = 8
+
+@njit(cache=True, fastmath=True)
+def _fs_dither_stripe(R, G, B, palette, code_table, out, y0, y1):
+    """Floyd-Steinberg dither rows [y0, y1) of three (H, W) uint8 planes.
+
+    The planes are dithered in place; diffused errors live in two int16
+    row buffers instead of a widened copy of the image. Rows are scanned
+    in serpentine order (alternating direction), and the color code of
+    every pixel is written to the flat uint8 buffer ``out`` in the same
+    pass, so no second walk over the image is needed.
+    """
+    H, W = R.shape
+    # Errors diffused into the current and the next row, per channel
+    err_cur = np.zeros((3, W), dtype=np.int16)
+    err_next = np.zeros((3, W), dtype=np.int16)
+    for y in range(y0, y1):
+        # Even rows run left to right, odd rows right to left
+        if y % 2 == 0:
+            x0 = 0
+            step = 1
+        else:
+            x0 = W - 1
+            step = -1
+
+        # 7/16 of the error carried to the next pixel along the row
+        cr = 0
+        cg = 0
+        cb = 0
+        for i in range(W):
+            x = x0 + step * i
+            r = R[y, x] + err_cur[0, x] + cr
+            g = G[y, x] + err_cur[1, x] + cg
+            b = B[y, x] + err_cur[2, x] + cb
+
+            # Nearest palette color (first match wins on ties)
+            best_idx = 0
+            best_dist = 1 << 30
+            for k in range(palette.shape[0]):
+                dr = r - palette[k, 0]
+                dg = g - palette[k, 1]
+                db = b - palette[k, 2]
+                dist = dr * dr + dg * dg + db * db
+                if dist < best_dist:
+                    best_dist = dist
+                    best_idx = k
+
+            R[y, x] = palette[best_idx, 0]
+            G[y, x] = palette[best_idx, 1]
+            B[y, x] = palette[best_idx, 2]
+            out[y * W + x] = code_table[best_idx]
+            er = r - palette[best_idx, 0]
+            eg = g - palette[best_idx, 1]
+            eb = b - palette[best_idx, 2]
+
+            # Distribute the quantization error to neighboring pixels
+            # (truncated toward zero, as the original float->int16 cast did)
+            cr = int(er * 7 / 16)
+            cg = int(eg * 7 / 16)
+            cb = int(eb * 7 / 16)
+            xb = x - step
+            if 0 <= xb < W:
+                err_next[0, xb] += int(er * 3 / 16)
+                err_next[1, xb] += int(eg * 3 / 16)
+                err_next[2, xb] += int(eb * 3 / 16)
+            err_next[0, x] += int(er * 5 / 16)
+            err_next[1, x] += int(eg * 5 / 16)
+            err_next[2, x] += int(eb * 5 / 16)
+            xf = x + step
+            if 0 <= xf < W:
+                err_next[0, xf] += int(er * 1 / 16)
+                err_next[1, xf] += int(eg * 1 / 16)
+                err_next[2, xf] += int(eb * 1 / 16)
+
+        # The next row's errors become current; start a fresh next row
+        err_cur, err_next = err_next, err_cur
+        err_next[:] = 0
+
+# Explicit signature: compiled eagerly at import, so the first upload after
+# boot doesn't pay the JIT cost
+@njit('void(uint8[:, ::1], uint8[:, ::1], uint8[:, ::1], int16[:, ::1], uint8[::1], uint8[::1], int64)',
+      parallel=True, cache=True, fastmath=True)
+def _fs_dither(R, G, B, palette, code_table, out, n_stripes):
+    """Dither three (H, W) uint8 planes as n_stripes parallel stripes.
+
+    No error crosses a stripe boundary, which leaves faint seams that
+    are not visible on the 7-color panel.
+    """
+    H = R.shape[0]
+    for s in prange(n_stripes):
+        _fs_dither_stripe(R, G, B, palette, code_table, out,
+                          s * H // n_stripes, (s + 1) * H // n_stripes)
+
+def _fs_dither_rows(R, G, B, palette, code_table, out, n_stripes):
+    """Floyd-Steinberg dither three (H, W) uint8 planes in place without Numba.
+
+    A per-pixel pure-Python loop over Python ints, one scanline at a time.
+    It uses the same stripes, serpentine order, exact palette search and
+    error rounding as _fs_dither, so both produce identical frames.
+    """
+    H, W = R.shape
+    colors = palette.tolist()
+    code_list = code_table.tolist()
+    stripe_starts = {s * H // n_stripes for s in range(n_stripes)}
+    for y in range(H):
+        if y in stripe_starts:
+            # First row of a stripe: nothing diffused into it from above.
+            # Next-row errors are padded by one pixel on each side.
+            ner = [0] * (W + 2)
+            neg = [0] * (W + 2)
+            neb = [0] * (W + 2)
+        rr = R[y].tolist()
+        gg = G[y].tolist()
+        bb = B[y].tolist()
+        row_codes = [0] * W
+        cer, ceg, ceb = ner, neg, neb
+        ner = [0] * (W + 2)
+        neg = [0] * (W + 2)
+        neb = [0] * (W + 2)
+        step = 1 if y % 2 == 0 else -1
+        cr = cg = cb = 0
+        for x in (range(W) if step == 1 else range(W - 1, -1, -1)):
+            r = rr[x] + cer[x + 1] + cr
+            g = gg[x] + ceg[x + 1] + cg
+            b = bb[x] + ceb[x + 1] + cb
+
+            # Nearest palette color (first match wins on ties)
+            idx = 0
+            best_dist = 1 << 30
+            for k, (pr, pg, pb) in enumerate(colors):
+                dist = (r - pr) ** 2 + (g - pg) ** 2 + (b - pb) ** 2
+                if dist < best_dist:
+                    best_dist = dist
+                    idx = k
+
+            nr, ng, nb = colors[idx]
+            rr[x] = nr
+            gg[x] = ng
+            bb[x] = nb
+            row_codes[x] = code_list[idx]
+            er = r - nr
+            eg = g - ng
+            eb = b - nb
+
+            cr = int(er * 7 / 16)
+            cg = int(eg * 7 / 16)
+            cb = int(eb * 7 / 16)
+            xb = x + 1 - step  # padded offsets behind and ahead of x
+            xa = x + 1 + step
+            ner[xb] += int(er * 3 / 16)
+            neg[xb] += int(eg * 3 / 16)
+            neb[xb] += int(eb * 3 / 16)
+            ner[x + 1] += int(er * 5 / 16)
+            neg[x + 1] += int(eg * 5 / 16)
+            neb[x + 1] += int(eb * 5 / 16)
+            ner[xa] += int(er * 1 / 16)
+            neg[xa] += int(eg * 1 / 16)
+            neb[xa] += int(eb * 1 / 16)
+
+        R[y] = rr
+        G[y] = gg
+        B[y] = bb
+        out[y * W:(y + 1) * W] = row_codes
+
+if not HAVE_NUMBA:
+    _fs_dither = _fs_dither_rows
+
+_dither_lock = threading.Lock()
+
+def _dither(image):
+    """Dither an RGB image; return its R, G, B uint8 planes and color codes."""
+    # One contiguous uint8 plane per channel
+    R, G, B = (np.array(band) for band in image.split()[:3])
+    codes = np.empty(image.width * image.height, dtype=np.uint8)
+    n_stripes = max(1, min(DITHER_STRIPES, image.height))
+    # Numba's default threading layer doesn't allow concurrent parallel calls
+    with _dither_lock:
+        _fs_dither(R, G, B, palette_arr, CODE_LUT, codes, n_stripes)
+    return (R, G, B), codes
+
 def apply_floyd_steinberg_dithering(image):
     """Apply Floyd-Steinberg dithering to the image."""
-    pixels = np.array(image, dtype=np.int16)
-    for y in range(image.height):
-        for x in range(image.width):
-            old_pixel = tuple(pixels[y, x][:3])
-            new_pixel = closest_palette_color(old_pixel)
-            pixels[y, x][:3] = new_pixel
-            quant_error = np.array(old_pixel) - np.array(new_pixel)
-            
-            # Distribute the quantization error to neighboring pixels
-            if x + 1 < image.width:
-                pixels[y, x + 1][:3] += (quant_error * 7 / 16).astype(np.int16)
-            if x - 1 >= 0 and y + 1 < image.height:
-                pixels[y + 1, x - 1][:3] += (quant_error * 3 / 16).astype(np.int16)
-            if y + 1 < image.height:
-                pixels[y + 1, x][:3] += (quant_error * 5 / 16).astype(np.int16)
-            if x + 1 < image.width and y + 1 < image.height:
-                pixels[y + 1, x + 1][:3] += (quant_error * 1 / 16).astype(np.int16)
-    
-    pixels = np.clip(pixels, 0, 255)
-    return Image.fromarray(pixels.astype(np.uint8))
+    planes, _ = _dither(image)
+    return Image.merge("RGB", [Image.fromarray(plane) for plane in planes])
 
-def process_image(image_data):
-    """Process uploaded image and convert to display format."""
+def process_image(image_bytes):
+    """Process uploaded image bytes and convert to display format."""
     try:
-        # Decode base64 image
-        image_bytes = base64.b64decode(image_data)
+        # Identical uploads reuse the previously processed frame
+        key = hashlib.sha256(image_bytes).digest()
+        cached = _IMG_CACHE.get(key)
+        if cached is not None:
+            try:
+                _IMG_CACHE.move_to_end(key)
+            except KeyError:
+                pass  # evicted by another request in the meantime
+            return cached
+        
         image = Image.open(BytesIO(image_bytes))
         
-        # Resize and convert
-        image = image.resize((600, 448))
-        image = image.convert("RGB")
+        # Convert and resize
+        image = image.convert("RGB").resize((600, 448))
         
-        # Apply dithering
-        dithered_image = apply_floyd_steinberg_dithering(image)
+        # Dither and map to ESP32 color codes in a single pass
+        _, codes = _dither(image)
         
-        # Create data array
-        data_array = []
-        for y in range(448):
-            for x in range(600):
-                rgb = dithered_image.getpixel((x, y))
-                color_code = color_palette.get(tuple(rgb), 0xFF)
-                data_array.append(f"0x{color_code:02X}")
+        processed_data = codes.tobytes()
         
-        return ", ".join(data_array)
+        _IMG_CACHE[key] = processed_data
+        if len(_IMG_CACHE) > IMG_CACHE_SIZE:
+            _IMG_CACHE.popitem(last=False)
+        return processed_data
     except Exception as e:
         print(f"Error processing image: {e}")
         return None
 
+def process_base64_image(image_data):
+    """Decode a base64-encoded upload and process it."""
+    try:
+        image_bytes = base64.b64decode(image_data)
+    except Exception as e:
+        print(f"Error decoding image: {e}")
+        return None
+    return process_image(image_bytes)
+
+def frame_etag(processed_data):
+    """ETag for a processed frame, computed once when it is stored."""
+    return hashlib.md5(processed_data).hexdigest()
+
+def store_processed_image(processed_data, name=None):
+    """Add a processed frame to the rotation and build the upload response."""
+    processed_images.append({
+        'data': processed_data,
+        'etag': frame_etag(processed_data),
+        'timestamp': datetime.now().isoformat(),
+        'name': name or f'image_{next(upload_counter)}'
+    })
+    
+    return jsonify({
+        "message": "Image uploaded and processed successfully",
+        "total_images": len(processed_images)
+    })
+
 @app.route('/', methods=['GET'])
 def home():
     return render_template('upload.html')
@@ -104,18 +338,28 @@ def upload_image():
         if 'image' not in data:
             return jsonify({"error": "No image data provided"}), 400
         
-        processed_data = process_image(data['image'])
+        processed_data = process_base64_image(data['image'])
         if processed_data:
-            processed_images.append({
-                'data': processed_data,
-                'timestamp': datetime.now().isoformat(),
-                'name': data.get('name', f'image_{len(processed_images) + 1}')
-            })
+            return store_processed_image(processed_data, data.get('name'))
+        else:
+            return jsonify({"error": "Failed to process image"}), 500
             
-            return jsonify({
-                "message": "Image uploaded and processed successfully",
-                "total_images": len(processed_images)
-            })
+    except Exception as e:
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+
+@app.route('/upload-raw', methods=['POST'])
+def upload_raw_image():
+    """Upload and process a new image sent as the raw request body."""
+    try:
+        # get_data() returns the body for any content type; request.data is
+        # empty for form types such as curl's default for --data-binary
+        image_bytes = request.get_data()
+        if not image_bytes:
+            return jsonify({"error": "No image data provided"}), 400
+        
+        processed_data = process_image(image_bytes)
+        if processed_data:
+            return store_processed_image(processed_data, request.args.get('name'))
         else:
             return jsonify({"error": "Failed to process image"}), 500
             
@@ -133,12 +377,28 @@ def get_img_data():
     # Randomly select an image instead of cycling through them
     image = random.choice(processed_images)
     
-    # Track sent images
-    if image not in sent_images:
+    # Track sent images (sent_images keeps them alive, so ids stay unique)
+    if id(image) not in sent_ids:
+        if len(sent_images) == sent_images.maxlen:
+            sent_ids.discard(id(sent_images[0]))
+        sent_ids.add(id(image))
         sent_images.append(image)
     
-    # Return the data in the format expected by ESP32
-    return image['data'], 200, {'Content-Type': 'text/plain'}
+    # Firmware that opts in gets one raw color code byte per pixel, row-major
+    if request.args.get('format') == 'bin':
+        # A device that already shows this frame gets an empty 304 instead
+        if image['etag'] in request.if_none_match:
+            return '', 304, {'ETag': f'"{image["etag"]}"', 'Cache-Control': 'no-cache'}
+        
+        response = Response(image['data'], mimetype='application/octet-stream')
+        response.set_etag(image['etag'])
+        # Frames rotate on every request, so caches must always revalidate
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    # Return the data in the format expected by ESP32 ("0xNN, 0xNN, ...")
+    codes = np.frombuffer(image['data'], dtype=np.uint8)
+    return ", ".join(HEXSTR[codes].tolist()), 200, {'Content-Type': 'text/plain'}
 
 @app.route('/status', methods=['GET'])
 def status():
@@ -163,15 +423,12 @@ def wakeup_interval():
     now = datetime.now()
     current_time = now.time()
 
-    # Define time boundaries
-    morning_time = time(8, 0)  # 8 AM
-    evening_time = time(20, 0)  # 8 PM
-
-    if morning_time <= current_time < evening_time:
-        interval = 3600  # 1 hour in seconds during day
+    if MORNING <= current_time < EVENING:
+        interval = DAY_INTERVAL
     else:
-        # Calculate seconds until the next 8 AM
-        next_morning = datetime.combine(now.date() + timedelta(days=1), morning_time)
+        # Calculate seconds until the next 8 AM (today if it's past midnight)
+        next_date = now.date() if current_time < MORNING else now.date() + timedelta(days=1)
+        next_morning = datetime.combine(next_date, MORNING)
         interval = int((next_morning - now).total_seconds())
 
     return jsonify(interval=interval)
@@ -210,7 +467,7 @@ def sync_google_photos():
             
             for photo in new_photos:
                 if photo.get('google_id') not in existing_ids:
-                    processed_images.append(photo)
+                    processed_images.append(dict(photo, etag=frame_etag(photo['data'])))
             
             return jsonify({
                 "message": f"Successfully synced {len(new_photos)} photos from Google Photos",
@@ -244,10 +501,13 @@ def setup_google_auth():
 @app.route('/clear-images', methods=['POST'])
 def clear_images():
     """Clear all stored images (for testing)."""
-    global processed_images, sent_images, current_image_index
-    processed_images = []
-    sent_images = []
+    global processed_images, sent_images, sent_ids, current_image_index, upload_counter
+    processed_images = deque(maxlen=MAX_IMAGES)
+    sent_images = deque(maxlen=MAX_IMAGES)
+    sent_ids = set()
     current_image_index = 0
+    upload_counter = count(1)
+    google_sync.processed_cache.clear()
     
     return jsonify({"message": "All images cleared"})
 
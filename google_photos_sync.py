@@ -5,12 +5,17 @@ Automatically fetches photos from a shared Google Photos album
 
 import os
 import requests
-import base64
 from datetime import datetime, timedelta
 from PIL import Image
 from io import BytesIO
 import json
-import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Photos downloaded concurrently during a sync
+DOWNLOAD_WORKERS = 8
+# Processed photos remembered between syncs (about 269 KB each)
+PROCESSED_CACHE_SIZE = 64
 
 class GooglePhotosSync:
     def __init__(self):
@@ -21,6 +26,10 @@ class GooglePhotosSync:
         self.album_id = os.getenv('GOOGLE_ALBUM_ID')
         self.access_token = None
         self.token_expires = None
+        # Processed photos by Google media item ID, so re-syncs skip downloads
+        self.processed_cache = OrderedDict()
+        # Shared session so connections to Google are reused across requests
+        self.session = requests.Session()
         
     def get_access_token(self):
         """Get or refresh Google Photos API access token"""
@@ -41,7 +50,7 @@ class GooglePhotosSync:
         }
         
         try:
-            response = requests.post(token_url, data=data)
+            response = self.session.post(token_url, data=data)
             token_data = response.json()
             
             if 'access_token' in token_data:
@@ -70,10 +79,6 @@ class GooglePhotosSync:
         
         # Search for media items in the album
         search_url = "https://photoslibrary.googleapis.com/v1/mediaItems:search"
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
         
         request_body = {
             'albumId': self.album_id,
@@ -81,7 +86,10 @@ class GooglePhotosSync:
         }
         
         try:
-            response = requests.post(search_url, headers=headers, json=request_body)
+            # Credentials go on this request only, not on the shared session
+            # that also fetches photo content
+            response = self.session.post(search_url, json=request_body,
+                                         headers={'Authorization': f'Bearer {access_token}'})
             
             if response.status_code == 200:
                 data = response.json()
@@ -95,18 +103,16 @@ class GooglePhotosSync:
             return []
     
     def download_photo(self, photo_item):
-        """Download a photo and return it as base64"""
+        """Download a photo and return its raw image bytes"""
         try:
             # Get the base URL and add download parameters
             base_url = photo_item['baseUrl']
             download_url = f"{base_url}=w600-h448-c"  # Resize to our target dimensions
             
-            response = requests.get(download_url)
+            response = self.session.get(download_url)
             if response.status_code == 200:
-                # Convert to base64
-                image_base64 = base64.b64encode(response.content).decode('utf-8')
                 return {
-                    'base64': image_base64,
+                    'image_bytes': response.content,
                     'filename': photo_item.get('filename', 'unknown.jpg'),
                     'creation_time': photo_item.get('mediaMetadata', {}).get('creationTime', ''),
                     'id': photo_item['id']
@@ -119,6 +125,13 @@ class GooglePhotosSync:
             print(f"Error downloading photo: {e}")
             return None
     
+    def remember_processed(self, photo_id, entry):
+        """Cache a processed photo, evicting the least recently synced one"""
+        self.processed_cache[photo_id] = entry
+        self.processed_cache.move_to_end(photo_id)
+        if len(self.processed_cache) > PROCESSED_CACHE_SIZE:
+            self.processed_cache.popitem(last=False)
+    
     def sync_album_photos(self, process_image_callback, max_photos=10):
         """Sync photos from Google Photos album and process them"""
         print(f"🔄 Syncing photos from Google Photos album...")
@@ -130,29 +143,47 @@ class GooglePhotosSync:
         
         print(f"📸 Found {len(photos)} photos in album")
         
+        # Take the cached entries up front, since storing new photos below can
+        # evict them from the cache
+        cached_entries = {photo['id']: self.processed_cache[photo['id']]
+                          for photo in photos if photo['id'] in self.processed_cache}
+        
+        # Download everything not processed on an earlier sync in parallel;
+        # processing stays on this thread since it is CPU-bound
+        pending = [photo for photo in photos if photo['id'] not in cached_entries]
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            downloads = dict(zip((photo['id'] for photo in pending),
+                                 executor.map(self.download_photo, pending)))
+        
         processed_photos = []
         for i, photo in enumerate(photos):
             print(f"🔄 Processing photo {i+1}/{len(photos)}: {photo.get('filename', 'unknown')}")
             
-            # Download the photo
-            downloaded = self.download_photo(photo)
+            # Photos processed on an earlier sync were never downloaded again
+            cached = cached_entries.get(photo['id'])
+            if cached:
+                self.remember_processed(photo['id'], cached)
+                processed_photos.append(dict(cached, timestamp=datetime.now().isoformat()))
+                print(f"✅ Already processed {cached['name']}")
+                continue
+            
+            downloaded = downloads[photo['id']]
             if downloaded:
                 # Process through the same pipeline as manual uploads
-                processed_data = process_image_callback(downloaded['base64'])
+                processed_data = process_image_callback(downloaded['image_bytes'])
                 if processed_data:
-                    processed_photos.append({
+                    entry = {
                         'data': processed_data,
                         'timestamp': datetime.now().isoformat(),
                         'name': downloaded['filename'],
                         'google_id': downloaded['id'],
                         'creation_time': downloaded['creation_time']
-                    })
+                    }
+                    self.remember_processed(downloaded['id'], entry)
+                    processed_photos.append(entry)
                     print(f"✅ Processed {downloaded['filename']}")
                 else:
                     print(f"❌ Failed to process {downloaded['filename']}")
-            
-            # Small delay to be nice to the API
-            time.sleep(0.5)
         
         print(f"🎉 Successfully processed {len(processed_photos)} photos")
         return processed_photos
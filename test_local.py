@@ -73,6 +73,14 @@ def test_server():
         print(f"❌ Failed to get image data: {response.text}")
         return False
     
+    response = requests.get(f"{BASE_URL}/get-img-data", params={"format": "bin"})
+    
+    if response.status_code == 200:
+        print(f"✅ Binary image data retrieved: {len(response.content)} bytes")
+    else:
+        print(f"❌ Failed to get binary image data: {response.text}")
+        return False
+    
     # Test 4: Check wakeup interval
     print("⏰ Testing wakeup interval...")
     response = requests.get(f"{BASE_URL}/wakeup-interval")